@@ -11,6 +11,7 @@
  
 #define WS2811_COUNT    8       // Number of WS2811 chips to send data to
 #define PIN             7       // Pin on which to send the WS2811 chip data over
+#define ACK_BYTE        0x01    // Byte sent back after each complete message, telling the sender it may send another one
 
 
 byte channels[3*WS2811_COUNT];  // Received 8-bit value per channel
@@ -37,6 +38,8 @@ void setup()
 // Process the incoming data and send it out to the connected WS2811 chips
 void loop() 
 { 
+  bool message_complete = false;
+
   // Process any byte received
   while (Serial.available() > 0) 
   {
@@ -75,12 +78,20 @@ void loop()
 
     // Force an update of the LEDs before continuing any further.
     if (curr_byte & 128)
+    {
+      message_complete = true;
       break;
+    }
   } 
   
   // Send out the latest data to the WS2811 chips
   for (int i = 0; i < WS2811_COUNT; ++i)
     pixels.setPixelColor(i, pixels.Color(channels[i * 3 + 0], channels[i * 3 + 1], channels[i * 3 + 2]));
   pixels.show();
-  
+
+  // Acknowledge the completed message now it has been sent out. The serial receive buffer (64 bytes on AVR) can't hold even one whole 
+  // message, so any message the sender pipelined behind this one isn't buffered as a whole. It's only received fine because loop() 
+  // keeps draining the incoming bytes between the short pixels.show() calls.
+  if (message_complete)
+    Serial.write(ACK_BYTE);
 }
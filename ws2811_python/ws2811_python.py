@@ -8,6 +8,15 @@
 # Attribution is very much appreciated but not required. Giliam de Carpentier, 2021. https://www.decarpentier.nl.
 
 # IMPORTS - Import any software dependencies.
+import numpy					# The NumPy module is used for calculating all light values in one go using arrays.
+								# Install using: python -m pip install numpy
+
+from numba import njit			# The Numba module is used for compiling the light calculations that run every refresh.
+								# Install using: python -m pip install numba
+								# The compiled code is cached in __pycache__, so only the very first run takes seconds to start.
+
+import os						# The os module is used for writing to the COM port directly, where the platform allows.
+
 import serial					# The pySerial module is used for communication over COM ports. 
 								# Install using: python -m pip install pyserial
 
@@ -23,142 +32,212 @@ real_filter_halflife = 0.02		# Real seconds after which 50% of a light value wil
 
 refresh_rate = 60				# Times per real the second the light values are recalculated, and sent when possible.
 
+max_messages_in_flight = 2		# Messages sent ahead to the Arduino before waiting for it to acknowledge the oldest one. 
+								# Note the Arduino doesn't buffer whole messages: its 64-byte receive buffer is smaller than 
+								# one message. This only works as it keeps reading bytes as they arrive, so raising it won't help.
 
-# FUNCTION - Get the light states based on the given time, specified as the (floating point) hour of the day.
-def get_light_floats_from_hour(hour):
-	lights = []
-		
-	# Calculate the triplet of building light values based on the time of day. This assumes the building is the very first ws2811 the 
+status_print_interval = 6		# Messages sent to the Arduino per printed status line.
+
+avoid_reset_on_open = True		# Keep DTR low when opening the COM port, so Arduinos with a DTR auto-reset circuit (e.g. Uno, Nano, Mega) 
+								# aren't reset. Set to False for boards with native USB (e.g. Leonardo, Micro, TinyUSB-based cores), 
+								# which only report the port as connected with DTR high and would otherwise never leave setup().
+
+
+# CONSTANTS - Values derived once at startup from the physical layout of the lights.
+num_lights = 3 + 8*6*3			# Number of light values: a triplet for the building, followed by a triplet for each dome chip.
+
+num_triplets = int(num_lights / 3)	# Number of ws2811 chips (each taking a triplet of light values) the data is sent to.
+
+# The light dome consists of a light strip serpentining from one side to the other, coming back to the same 'angle' every 16 chips.
+# The angle per chip is represented by j, going 0.5, 1.5, 2.5, 3.5, 4.5, 5.5, 6.5*, 7.5*, 5.5, 4.5, 3.5, 2.5, 1.5, 0.5, -0.5*, -1.5*. 
+# The values marked with a * are all roughly on both sides of the horizon, but area all slightly different to a more varied look.
+sky_j = (numpy.arange(8*6) + 0.5) % 16
+sky_j = numpy.where(sky_j >= 8, 14 - sky_j, sky_j).astype(numpy.float32)
+sky_phase = sky_j - 3			# Offset of each dome chip's angle relative to the sun's angle at noon.
+
+# The dither pattern added per triplet when turning light values into 8-bit values. There's many ways to do this, but this one is based 
+# on the golden ratio. This replaces the banding/snapping effect to 8-bit values with arguably less objectionable noise patterns.
+dither_pattern = ((numpy.arange(1, num_triplets + 1) * -0.61803398875) % 1.0).astype(numpy.float32)
+
+
+# FUNCTION - Get the triplet of building light values based on the given time, specified as the (floating point) hour of the day.
+def get_building_floats_from_hour(hour):
+	return [0.25 if ((hour > 15.0 or hour < 9.0)) else 0,
+	        0.25 if ((hour > 17.0 and hour < 19.5) or (hour > 5.5 and hour < 8.0)) else 0,
+	        1.00 if ((hour > 4.0 and hour < 21.0)) else 0]
+
+
+# The building lights only switch on whole minutes, so evaluate them once per simulated minute of the day and look them up instead.
+building_lut = numpy.array([get_building_floats_from_hour((minute + 0.5) / 60) for minute in range(24 * 60)], dtype=numpy.float32)
+
+
+# BUFFERS - Arrays allocated once at startup and overwritten in place every refresh by the main loop.
+unfiltered_floats = numpy.empty(num_lights, dtype=numpy.float32)	# Target value per light for the current time.
+filtered_floats = numpy.empty(num_lights, dtype=numpy.float32)		# Eased in/out value per light, as sent to the Arduino.
+stream_buffer = bytearray(num_triplets * 4)							# Stream handed as-is to the COM port, needing no conversion.
+stream_view = numpy.frombuffer(stream_buffer, dtype=numpy.uint8)	# The same stream as an array the compiled functions can write.
+
+
+# FUNCTION - Write the light states based on the given time, specified as the (floating point) hour of the day, into 'lights'.
+@njit("void(float64, float32[::1])", cache=True, fastmath=True)
+def get_light_floats_from_hour(hour, lights):
+	# Look up the triplet of building light values based on the time of day. This assumes the building is the very first ws2811 the 
 	# Arduino's data signal passes.
-	lights.append(0.25 if ((hour > 15.0 or hour < 9.0)) else 0)                                    		
-	lights.append(0.25 if ((hour > 17.0 and hour < 19.5) or (hour > 5.5 and hour < 8.0)) else 0)	
-	lights.append(1.00 if ((hour > 4.0 and hour < 21.0)) else 0)    								
+	lights[0:3] = building_lut[int(hour * 60) % (24 * 60)]
 	
-	# Calculate the colors in the sky dome. This assumes the dome is connected to the building's ws2811 data output.
+	# Calculate the colors in the sky dome. This assumes the dome is connected to the building's ws2811 data output. Calculate the 
+	# intensities of the 3 components in the sky: starlight, skylight and sunlight. Light values are randomly jittered later, when 
+	# turning into 8-bit values, to replace banding artifacts with noise artifacts. But this can also be abused to generate a random 
+	# starfield.
+	stars = 0.01
+	sky = (max(0, min(1, 0.15 * (9.5 - abs(hour - 12)))) ** 2)
 	for i in range(8*6):
-		# The light dome consists of a light strip serpentining from one side to the other, coming back to the same 'angle' every 16 chips.
-		# The angle is represented by j, going 0.5, 1.5, 2.5, 3.5, 4.5, 5.5, 6.5*, 7.5*, 5.5, 4.5, 3.5, 2.5, 1.5, 0.5, -0.5*, -1.5*. 
-		# The values marked with a * are all roughly on both sides of the horizon, but area all 
-		# slightly different to a more varied look.
-		j = (i + 0.5) % 16
-		if j >= 8: j = 14 - j;
-		# Calculate the intensities of the 3 components in the sky: starlight, skylight and sunlight. Light values are randomly jittered 
-		# later, when turning into 8-bit values, to replace banding artifacts with noise artifacts. But this can also be abused to 
-		# generate a random starfield.
-		stars = 0.01
-		sky = (max(0, min(1, 0.15 * (9.5 - abs(hour - 12)))) ** 2)
-		sun = max(0, 1.0 - 0.125 * (abs((12 - hour) * 1 + 1 * (j - 3)))) ** 2
+		sun = max(0, 1.0 - 0.125 * (abs((12 - hour) * 1 + 1 * sky_phase[i]))) ** 2
 		# Turn the intensities into a summed color and add it to the values to process and send out. Colors aren't very transferable 
 		# from one set of LED strips to another, so this is just something that worked for my strip in particular, which is in 
 		# Blue-Red-Green order.
-		lights.append((min(1, stars + 0.3 * sky - 0.20 * sun)) ** 2) # Blue 	
-		lights.append((min(1, stars + 0.3 * sky + 0.60 * sun)) ** 2) # Red
-		lights.append((min(1, stars + 0.3 * sky + 0.15 * sun)) ** 2) # Green
-	
-	# Return the array of all scalar light values 
-	return lights
+		lights[3 + 3 * i + 0] = (min(1, stars + 0.3 * sky - 0.20 * sun)) ** 2 # Blue 	
+		lights[3 + 3 * i + 1] = (min(1, stars + 0.3 * sky + 0.60 * sun)) ** 2 # Red
+		lights[3 + 3 * i + 2] = (min(1, stars + 0.3 * sky + 0.15 * sun)) ** 2 # Green
 
 
-# FUNCTION - Get a list of clamped 0...255 values from a list of floats
+# FUNCTION - Get a clamped 0...255 value from a float. Compiled, this is inlined into build_stream as branchless min/max instructions, 
+# which turned out faster than one separate numpy.clip(...).astype(numpy.uint8) pass over all values and its temporary arrays. It's 
+# also faster than looking the byte up in a table indexed by quantized value and dither, which would still need its index clamped.
+@njit("int64(float32, float32)", cache=True, fastmath=True)
 def float_to_clamped_byte(value, dither):
-	return max(0, min(255, int(255 * value + dither)))
+	return max(0, min(255, int(numpy.float32(255) * value + dither)))
 
 
-# FUNCTION - Turn the given list of 0...1 values into 0...255 values, adding some jittering per three to hide banding.
-def get_bytes_from_floats(values):
-	data = []
-	num_triplets = int(len(values) / 3)
-	dither = 0
-	for i in range(num_triplets):
-		# Update the dither pattern. There's many ways to do this, but this one is based on the golden ratio. 
-		# This replaces the banding/snapping effect to 8-bit values with arguably less objectionable noise patterns.
-		dither -= 0.61803398875
-		if dither < 0: dither += 1
-		
-		# Prepare the next 3 float values as bytes
-		data.append(float_to_clamped_byte(values[3 * i + 0], dither)) # Convert third in triplet as a 0-255 'green' value.
-		data.append(float_to_clamped_byte(values[3 * i + 1], dither)) # Convert first in triplet as a 0-255 'red' value.
-		data.append(float_to_clamped_byte(values[3 * i + 2], dither)) # Convert second in triplet as a 0-255 'blue' value.
-		
-	return data		
+# FUNCTION - Ease the filtered light values in place towards the unfiltered ones, keeping 'weight' of the filtered value per call.
+@njit("void(float32[::1], float32[::1], float32)", cache=True, fastmath=True)
+def apply_filter(filtered, unfiltered, weight):
+	# Compiled, this plain loop updates the array in a single pass without any temporary arrays, which beats the equivalent NumPy 
+	# expression 'filtered[:] = unfiltered + (filtered - unfiltered) * weight' for arrays this small.
+	for i in range(len(filtered)):
+		filtered[i] = unfiltered[i] + (filtered[i] - unfiltered[i]) * weight
 
 
-# FUNCTION - Turn the given list of bytes (in groups of 3) into a serial data stream that the Arduino understands.
-def get_stream_from_bytes(bytes):
-	data = []
-	num_triplets = int(len(bytes) / 3)
+# FUNCTION - Turn the given array of 0...1 values into 0...255 values, adding some jittering per three to hide banding, and write them 
+# into 'stream' as the serial data stream that the Arduino understands.
+@njit("void(float32[::1], uint8[::1])", cache=True, fastmath=True)
+def build_stream(values, stream):
+	num_triplets = int(len(values) / 3)
 	for i in range(num_triplets):
+		dither = dither_pattern[i]
 		
-		# Get the next 3 bytes representing X, Y and Z, respectively. And XYZ could be RGB, GRB, BRG, etc.
-		x = bytes[3 * i + 0]
-		y = bytes[3 * i + 1]
-		z = bytes[3 * i + 2]
+		# Convert the next 3 float values to the bytes X, Y and Z, respectively. And XYZ could be RGB, GRB, BRG, etc.
+		x = float_to_clamped_byte(values[3 * i + 0], dither)
+		y = float_to_clamped_byte(values[3 * i + 1], dither)
+		z = float_to_clamped_byte(values[3 * i + 2], dither)
 				
-		# Pack the three bytes as four 6-bit values, leaving bit 6 and 7 for message control.
-		message_end = 1 if i == num_triplets - 1 else 0		# 1 if this is the very last triplet to send. 0 otherwise.
-		data.append((x >> 2) & 0x3f)						# Packed byte 0: '00xxxxxx', MSB first
-		data.append(((x & 0x03) << 4) | ((y >> 4) & 0x0f))	# Packed byte 1: '00xxyyyy', MSB first,
-		data.append(((y & 0x0f) << 2) | ((z >> 6) & 0x03))	# Packed byte 2: '00yyyyzz', MSB first.
-		data.append((z & 0x3f) | (message_end << 7))		# Packed byte 3: 'e0zzzzzz', MSB first, e being 'message_end'
-		
-	return data		
-	
-	
+		# Pack the three bytes as four 6-bit values, leaving bit 6 and 7 for message control. Combining them into one 24-bit value first 
+		# turns this into simply cutting that value into consecutive 6-bit pieces.
+		message_end = 1 if i == num_triplets - 1 else 0				# 1 if this is the very last triplet to send. 0 otherwise.
+		packed = (x << 16) | (y << 8) | z							# 'xxxxxxxxyyyyyyyyzzzzzzzz', MSB first
+		stream[4 * i + 0] = (packed >> 18) & 0x3f					# Packed byte 0: '00xxxxxx', MSB first
+		stream[4 * i + 1] = (packed >> 12) & 0x3f					# Packed byte 1: '00xxyyyy', MSB first,
+		stream[4 * i + 2] = (packed >> 6) & 0x3f					# Packed byte 2: '00yyyyzz', MSB first.
+		stream[4 * i + 3] = (packed & 0x3f) | (message_end << 7)	# Packed byte 3: 'e0zzzzzz', MSB first, e being 'message_end'
+
+
 # FUNCTION - Generate text describing the current state in one human-readable string.
-def get_human_readable_state(hour, bytes):
+def get_human_readable_state(hour, stream):
 	# Make time string
 	hours_only = int(hour)
 	minutes_only = int((hour - hours_only) * 60)
 	text = " Clock: {:02d}:{:02d}. Lights: |".format(hours_only, minutes_only)
 
-	# Append the formatted light float values to 'text'
-	for i in range(int(len(bytes) / 3)):
-		text += " {:02x} {:02x} {:02x}.".format(bytes[i * 3 + 0], bytes[i * 3 + 1], bytes[i * 3 + 2])
-	
-	return text
+	# Unpack each group of four 6-bit values in the stream back into three bytes
+	packed = [((stream[i + 0] & 0x3f) << 18) | ((stream[i + 1] & 0x3f) << 12) | ((stream[i + 2] & 0x3f) << 6) | (stream[i + 3] & 0x3f)
+	          for i in range(0, len(stream), 4)]
+
+	# Append the formatted byte values to 'text' in one go
+	return text + "".join(" {:02x} {:02x} {:02x}.".format(p >> 16, (p >> 8) & 0xff, p & 0xff) for p in packed)
 		
 	
+# FUNCTION - Send the whole stream over the COM port. Where it has a file descriptor (i.e. not on Windows), write to that directly, 
+# bypassing pyserial's locking and timeout handling for the usual case of the OS accepting all of it at once.
+def write_stream(serial_connection, fd, stream):
+	written = 0
+	if fd is not None:
+		try:
+			written = os.write(fd, stream)
+		except BlockingIOError:
+			pass
+	
+	# Leave anything the OS didn't accept right away to pyserial, which waits for room (up to its write timeout).
+	if written < len(stream):
+		serial_connection.write(memoryview(stream)[written:])
+
+
 # FUNCTION - Main function doing the day-night cycle and light update
 def main_loop(serial_connection):
-	sim_hour = 0							# simulated time at startup, in hours.
+	sim_hour = 0.0						# simulated time at startup, in hours.
 
 	# Calculate how much of the filtered light value will remain per refresh
 	real_filter_weight = 0.5 ** (1.0 / (refresh_rate * real_filter_halflife))
 
-	# Prepare state variables updated in the loop below
-	next_refresh_time = time.perf_counter()
-	filtered_floats = []
+	# Prepare state variables updated in the loop below. The filtered light values start out at their target values.
+	start_ns = time.perf_counter_ns()
+	num_refreshes = 0
+	next_refresh_ns = start_ns
+	messages_in_flight = 0
+	messages_sent = 0
+	read_ack = serial_connection.read
+	try:
+		fd = serial_connection.fileno()
+	except Exception:
+		fd = None
+	get_light_floats_from_hour(sim_hour, filtered_floats)
 
 	while True:
 		# Wait until the real time arrived to refresh the state again
-		time.sleep(max(0, next_refresh_time - time.perf_counter()));
+		time.sleep(max(0, next_refresh_ns - time.perf_counter_ns()) / 1e9);
+		
+		# Count as many updates as needed to get back to the current time. Each refresh time is derived from the start time, so the 
+		# integer division doesn't make any rounding error add up over time.
+		num_updates = 0
+		while next_refresh_ns < time.perf_counter_ns():
+			num_refreshes += 1
+			next_refresh_ns = start_ns + num_refreshes * 1000000000 // refresh_rate
+			num_updates += 1
 		
-		# Calculate as many updates to get back to the current time
-		while next_refresh_time - time.perf_counter() < 0:
-			next_refresh_time += 1.0 / refresh_rate;
-			sim_hour = (sim_hour + 1.0 / (refresh_rate * real_seconds_per_sim_hour)) % 24.0
+		if num_updates > 0:
+			sim_hour = (sim_hour + num_updates / (refresh_rate * real_seconds_per_sim_hour)) % 24.0
 							
-			# Calculate the target value for each light, and also use it the 'old' value is there aren't any old values yet.
-			unfiltered_floats = get_light_floats_from_hour(sim_hour)
-			if len(filtered_floats) != len(unfiltered_floats):
-				filtered_floats = unfiltered_floats
+			# Calculate the target value for each light. Only the latest time is used, as only the final result is sent anyway.
+			get_light_floats_from_hour(sim_hour, unfiltered_floats)
 				
 			# Ease in/out each target light value based on real_filter_halflife. This makes LEDs turn on/off more slowly, adding an 
-			# 'incandescent light bulb' feel to them.
-			for i in range(len(filtered_floats)):
-				filtered_floats[i] = unfiltered_floats[i] + (filtered_floats[i] - unfiltered_floats[i]) * real_filter_weight
-
-		# Convert the filtered light values into a byte stream and send it to the Arduino for further processing.
-		bytes = get_bytes_from_floats(filtered_floats)
-		stream = get_stream_from_bytes(bytes)
-		serial_connection.write(stream)
+			# 'incandescent light bulb' feel to them. Applying the filter once with the weight raised to the number of updates is the 
+			# same as applying it once per update towards this same target.
+			apply_filter(filtered_floats, unfiltered_floats, real_filter_weight ** num_updates)
+
+		# Convert the filtered light values into a byte stream.
+		build_stream(filtered_floats, stream_view)
+		
+		# Wait for the Arduino to send back a value for the oldest message if too many are still being processed, acknowlegding it's 
+		# ready to receive more. If a read times out, an acknowledgement got lost or is late. Then resynchronize by dropping anything 
+		# still in the input buffer and writing off all messages in flight, so a late acknowledgement can't be counted against a 
+		# later message, and a missing one can't stall forever.
+		while messages_in_flight >= max_messages_in_flight:
+			if len(read_ack(1)) > 0:
+				messages_in_flight -= 1
+			else:
+				serial_connection.reset_input_buffer()
+				messages_in_flight = 0
 		
-		# Wait for the Arduino to send back a value, acknowlegding the data has been processed and it's ready to receive more.
-		serial_connection.flush()
-		serial_connection.read(1)
+		# Send the byte stream to the Arduino for further processing, without waiting for it to be processed. There's no need to flush 
+		# and wait for the stream to have left the OS either, as the acknowledgements already tell when it has arrived.
+		write_stream(serial_connection, fd, stream_buffer)
+		messages_in_flight += 1
+		messages_sent += 1
 		
-		# Use the following line to dump the time and light states on the same TTY line
-		print(get_human_readable_state(sim_hour, bytes), end='\r', flush=True)
+		# Use the following lines to dump the time and light states on the same TTY line. Not doing this for every message saves the 
+		# time spent on writing and redrawing the terminal, while still updating the line more often than the eye can follow.
+		if messages_sent % status_print_interval == 0:
+			print(get_human_readable_state(sim_hour, stream_buffer), end='\r', flush=True)
 		
 	
 	
@@ -172,7 +251,13 @@ if __name__ == "__main__":
 	serial_name = sys.argv[1]
 	serial_connection = None
 	try:
-		serial_connection = serial.Serial(port=serial_name, baudrate=115200, timeout=0.25, write_timeout=0.25)	
+		# Configure the port before opening it, so DTR can be kept low on opening if resets are to be avoided. This only prevents the 
+		# reset on Windows. On other platforms, opening the port raises DTR before pyserial gets the chance to clear it.
+		serial_connection = serial.Serial(baudrate=115200, timeout=0.25, write_timeout=0.25)
+		serial_connection.port = serial_name
+		if avoid_reset_on_open:
+			serial_connection.dtr = False
+		serial_connection.open()
 		print("Succesfully connected to COM port " + serial_name)
 	except Exception as e:
 		print("Failed to connect to COM port" + serial_name + ": " + str(e))